@@ -1,32 +1,141 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import httpx
+import uvicorn
+import asyncio
 import os
-from typing import Optional
+from typing import List
 import logging
 from dotenv import load_dotenv
 import re
 import json
-from datetime import datetime
+import orjson
+from datetime import datetime, timedelta
 import base64
+import hashlib
+import io
+import random
+import time
+import uuid
+
+try:
+    import ahocorasick
+except ImportError:  # Optional: falls back to plain substring checks
+    ahocorasick = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional: large images are sent without downscaling
+    Image = ImageOps = None
+
+try:
+    import pyvips
+except (ImportError, OSError):  # Optional: needs libvips installed; Pillow is used otherwise
+    pyvips = None
+
+try:
+    from azure.storage.blob import BlobSasPermissions, ContainerClient, ContentSettings, generate_blob_sas
+except ImportError:  # Optional: images are always sent inline as base64
+    ContainerClient = None
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging, falling back to INFO if LOG_LEVEL isn't a level name
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+log_level = getattr(logging, LOG_LEVEL, None)
+logging.basicConfig(level=log_level if isinstance(log_level, int) else logging.INFO)
 logger = logging.getLogger(__name__)
+if not isinstance(log_level, int):
+    logger.warning(f"Invalid LOG_LEVEL {LOG_LEVEL!r}, using INFO")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create one pooled HTTP client per worker and close it on shutdown"""
+    # Reusing the client keeps TLS sessions to Azure alive between requests
+    app.state.http_client = httpx.AsyncClient(
+        # Fail fast on connection setup; leave room for long completions
+        timeout=httpx.Timeout(connect=5.0, read=90.0, write=30.0, pool=5.0),
+        limits=httpx.Limits(
+            max_keepalive_connections=100,
+            max_connections=200,
+            keepalive_expiry=75.0
+        ),
+        http2=True
+    )
+    # Bounds in-flight Azure OpenAI calls across all requests handled by this worker
+    app.state.azure_semaphore = asyncio.Semaphore(AZURE_MAX_CONCURRENCY)
+    app.state.request_bucket = AsyncTokenBucket(AZURE_REQUESTS_PER_MINUTE)
+    app.state.token_bucket = AsyncTokenBucket(AZURE_TOKENS_PER_MINUTE)
+    app.state.analysis_cache = AnalysisCache(ANALYSIS_CACHE_SIZE, ANALYSIS_CACHE_TTL)
+    # Resizing and base64 run on their own pool, so CPU-heavy uploads can't
+    # starve the default executor that serves Blob I/O and DNS lookups
+    app.state.thread_pool = ThreadPoolExecutor(
+        max_workers=THREAD_POOL_WORKERS, thread_name_prefix="coin-worker"
+    )
+    app.state.blob_container = None
+    app.state.blob_deletes = set()
+    if AZURE_STORAGE_CONNECTION_STRING and ContainerClient is not None:
+        container = ContainerClient.from_connection_string(
+            AZURE_STORAGE_CONNECTION_STRING, AZURE_STORAGE_CONTAINER
+        )
+        # SAS URLs are signed with the account key; without one every upload would fail
+        if getattr(container.credential, "account_key", None):
+            app.state.blob_container = container
+        else:
+            logger.warning(
+                "AZURE_STORAGE_CONNECTION_STRING has no account key; sending images inline as base64"
+            )
+            container.close()
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
+        if app.state.blob_container is not None:
+            if app.state.blob_deletes:
+                await asyncio.gather(*app.state.blob_deletes, return_exceptions=True)
+            app.state.blob_container.close()
+        app.state.thread_pool.shutdown(wait=False)
 
 app = FastAPI(
     title="Coin Analyzer API",
     description="Analyze coins using OpenAI GPT-4 Vision",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Azure OpenAI configuration
 AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
+AZURE_MAX_CONCURRENCY = int(os.getenv("AZURE_MAX_CONCURRENCY", "8"))
+
+# Deployment quota to pace calls against; 0 disables pacing. Each call is
+# charged its max_tokens against the token quota, as Azure does
+AZURE_REQUESTS_PER_MINUTE = int(os.getenv("AZURE_REQUESTS_PER_MINUTE", "0"))
+AZURE_TOKENS_PER_MINUTE = int(os.getenv("AZURE_TOKENS_PER_MINUTE", "0"))
+
+# Attempts per Azure call when it is rate limited or fails with a transient error
+AZURE_MAX_ATTEMPTS = 5
+AZURE_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Optional Blob Storage for handing images to Azure OpenAI by URL instead of
+# base64; the connection string must include the account key to sign SAS URLs
+AZURE_STORAGE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
+AZURE_STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER", "coin-uploads")
+BLOB_SAS_TTL = 600
+
+# Threads for image resizing and base64 encoding
+THREAD_POOL_WORKERS = int(os.getenv("THREAD_POOL_WORKERS", str((os.cpu_count() or 1) * 2)))
+
+# In-process cache of analyses keyed by image content
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "1024"))
+ANALYSIS_CACHE_TTL = float(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
 
 if not AZURE_OPENAI_API_KEY:
     logger.warning("AZURE_OPENAI_API_KEY not found in environment variables")
@@ -36,163 +145,293 @@ if not AZURE_OPENAI_ENDPOINT:
 # Azure OpenAI API URL
 AZURE_OPENAI_API_URL = f"{AZURE_OPENAI_ENDPOINT}/openai/deployments/{AZURE_OPENAI_DEPLOYMENT_NAME}/chat/completions?api-version=2025-01-01-preview"
 
-# Initialize Azure OpenAI client (will be used if needed)
-client = None
+# System prompt describing the analysis and the JSON structure we expect back
+SYSTEM_PROMPT = "Analyze an image of a coin and provide detailed information about it following a structured JSON output format.\n\nYour task is to extract and identify relevant information from the image provided, including historical, technical, and value-related details about the coin. The JSON output must strictly adhere to the specified structure and include all fields, even if some values are unknown.\n\n# Steps\n\n1. **Image Analysis**\n   - Examine the image for visual characteristics such as inscriptions, symbols, design elements, and patterns.\n   - Identify visible text, numbers, or symbols to infer the country of origin, denomination, composition, mint mark, and release year.\n\n2. **Infer Historical Context**\n   - Based on the appearance and known symbols, extract the significance of the coin in its national or historical setting.\n   - If possible, describe symbolic representations or notable historical events related to the coin.\n\n3. **Determine Value**\n   - Assess rarity, collector interest, or other factors that may provide insight into the coin's monetary or historical value.\n   - Use contextual clues (e.g., mint mark, visible inscriptions, or styles) to estimate the collector value.\n\n4. **Extract Technical Details**\n   - Note physical specifications such as mint mark, material composition, diameter (in millimeters), and other data inferred from design features.\n\n5. **Compile Metadata**\n   - Add details pertaining to the analysis process, including timestamps, size of the image file, filename, and AI model used.\n\n6. **Present the Data in Predefined JSON Format**\n   - Ensure all fields are included, and default to `\"unknown\"` unless information is reliably inferred.\n\n# Output Format\n\nThe result should adhere strictly to the following JSON structure:\n\n```json\n{\n  \"success\": true,\n  \"timestamp\": \"[ISO 8601 timestamp]\",\n  \"coin_analysis\": {\n    \"basic_info\": {\n      \"released_year\": \"[value or 'unknown']\",\n      \"country\": \"[value or 'unknown']\",\n      \"denomination\": \"[value or 'unknown']\",\n      \"composition\": \"[value or 'unknown']\"\n    },\n    \"value_assessment\": {\n      \"collector_value\": \"[value or 'unknown']\",\n      \"rarity\": \"[value or 'unknown']\"\n    },\n    \"description\": \"[Descriptive narrative relevant to the coin's artistic and symbolic features]\",\n    \"historical_context\": \"[Historical or cultural context relevant to the coin]\",\n    \"technical_details\": {\n      \"mint_mark\": \"[value or 'unknown']\",\n      \"diameter_mm\": \"[value or 'unknown']\",\n      \"composition\": \"[value or 'unknown']\"\n    }\n  },\n  \"metadata\": {\n    \"model_used\": \"[AI model name]\",\n    \"image_filename\": \"[image filename]\",\n    \"image_size_bytes\": \"[size in bytes]\",\n    \"processing_time\": \"[ISO 8601 timestamp]\"\n  }\n}\n```\n\n# Notes\n\n- **Fallback Values**: If information cannot be confidently recovered from the image, provide `\"unknown\"` but apply logical deductions where practical.  \n- **Consistency**: Ensure filenames, file size, and analysis timestamps match the input data provided.  \n- **Attention to Detail**: Provide comprehensive descriptions and avoid overly generic statements in historical and artistic contexts.  \n- **ISO 8601 Compliance**: Ensure all timestamps are in the ISO 8601 format for consistency and standardization.\n\nRespond ONLY with JSON, with no markdown code fences or other text. Unless asked for several coins in another form, reply with a single object matching this structure."
+
+# Static parts of every chat completion payload, built once at import
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [
+        {
+            "type": "text",
+            "text": SYSTEM_PROMPT
+        }
+    ]
+}
+NEWLINE_PART = {
+    "type": "text",
+    "text": "\n"
+}
+PAYLOAD_BASE = {
+    # JSON mode: the reply is guaranteed to be one parseable JSON object
+    "response_format": {"type": "json_object"},
+    "max_tokens": 6553,
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "stop": None,
+    "stream": False
+}
+
+# Image types Azure OpenAI accepts, mapped to the subtype used in data URLs
+IMAGE_MIME_EXTENSIONS = {
+    "image/jpeg": "jpeg",
+    "image/jpg": "jpeg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif"
+}
+
+# Largest upload accepted; reading stops as soon as it is exceeded
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(15 * 1024 * 1024)))
+
+# Uploads are read in chunks; the base64-encoded images are spliced into the
+# serialized payload rather than embedded in it
+IMAGE_READ_CHUNK_SIZE = 64 * 1024
+
+# Uploads larger than the threshold are downscaled to fit IMAGE_MAX_EDGE and
+# recompressed as JPEG; GPT-4o gains nothing from more pixels than that
+IMAGE_SHRINK_THRESHOLD = 512 * 1024
+IMAGE_MAX_EDGE = 1024
+
+# /analyze_batch accepts up to BATCH_MAX_IMAGES uploads and sends them to Azure
+# OpenAI in concurrent requests of at most BATCH_IMAGES_PER_REQUEST images each.
+# Each request's max_tokens is scaled by BATCH_TOKENS_PER_IMAGE, so the reply
+# has room for every analysis; a full group stays under the single-image budget
+BATCH_MAX_IMAGES = 50
+BATCH_IMAGES_PER_REQUEST = 4
+BATCH_TOKENS_PER_IMAGE = 1600
+
+BATCH_INSTRUCTION = (
+    "The following {count} images each show a different coin. Analyze every coin separately "
+    "and respond with a JSON object of the form {{\"coins\": [...]}} holding one analysis per "
+    "image, in the same order as the images, each following the structure above."
+)
+
+# Changes whenever the prompt or request settings do, so cached analyses never outlive them
+PROMPT_VERSION = hashlib.sha256(
+    SYSTEM_PROMPT.encode()
+    + orjson.dumps(PAYLOAD_BASE, option=orjson.OPT_SORT_KEYS)
+    + BATCH_INSTRUCTION.encode()
+).hexdigest()[:12]
+
+# Connection attempts per Azure call and the largest reply we are willing to parse
+AZURE_CONNECT_ATTEMPTS = 3
+AZURE_MAX_RESPONSE_BYTES = 512 * 1024
+# Longest we sleep before retrying, whatever Azure's retry-after header asks for
+AZURE_MAX_RETRY_DELAY = 30.0
+
+# Patterns and decoder used to pull JSON out of free-form model output
+_RE_JSON_FENCE = re.compile(r"```json(.*?)```", re.DOTALL)
+_RE_ANY_FENCE = re.compile(r"```(.*?)```", re.DOTALL)
+_JSON_DECODER = json.JSONDecoder()
 
 # Extract JSON from markdown-style code block
 def extract_json(text):
     try:
+        text = text.strip()
+        
+        # Fast path: the model usually answers with a bare JSON object
+        if text.startswith("{"):
+            try:
+                return orjson.loads(text)
+            except json.JSONDecodeError:
+                pass
+        
+        # Response is a single fenced block - slice it without a regex
+        if text.startswith("```"):
+            end = text.find("```", 3)
+            if end != -1:
+                block = text[3:end]
+                if block.startswith("json"):
+                    block = block[4:]
+                try:
+                    return orjson.loads(block.strip())
+                except json.JSONDecodeError:
+                    pass
+        
         # First, try to find JSON in markdown code blocks
-        clean = re.search(r"```json(.*?)```", text, re.DOTALL)
+        clean = _RE_JSON_FENCE.search(text)
         if clean:
-            return json.loads(clean.group(1).strip())
+            return orjson.loads(clean.group(1).strip())
         
         # Try to find JSON in regular code blocks
-        clean = re.search(r"```(.*?)```", text, re.DOTALL)
+        clean = _RE_ANY_FENCE.search(text)
         if clean:
             try:
-                return json.loads(clean.group(1).strip())
+                return orjson.loads(clean.group(1).strip())
             except:
                 pass
         
-        # Try to find JSON object in the text
-        json_match = re.search(r'\{.*\}', text, re.DOTALL)
-        if json_match:
-            return json.loads(json_match.group(0))
+        # Try to decode the first JSON object embedded in the text
+        start = text.find("{")
+        if start != -1:
+            return _JSON_DECODER.raw_decode(text, start)[0]
         
         # Try direct JSON parsing
-        return json.loads(text.strip())
+        return orjson.loads(text)
     except Exception as e:
         logger.warning(f"JSON extraction failed: {e}")
         logger.warning(f"Raw text: {text[:500]}...")  # Log first 500 chars for debugging
         return {"raw": text}
 
+# Possible field names for each response field, in priority order
+FIELD_ALIASES = {
+    "released_year": ["year first released", "year", "release_year", "mint_year", "first_released", "issued_year"],
+    "country": ["country", "nation", "origin", "issuing_country"],
+    "denomination": ["denomination", "value", "face_value", "coin_value", "monetary_value"],
+    "composition": ["composition", "material", "metal", "alloy", "composition_material"],
+    "collector_value": ["value", "collector_value", "market_value", "estimated_value", "worth"],
+    "rarity": ["rarity", "scarcity", "availability", "rarity_level"],
+    "description": ["description", "description_text", "coin_description", "details"],
+    "historical_context": ["historical_context", "history", "historical_background", "context"]
+}
+
+# Reverse index: field name -> [(response field, priority)]; one name can feed several fields
+FIELD_INDEX = {}
+for field, aliases in FIELD_ALIASES.items():
+    for rank, alias in enumerate(aliases):
+        FIELD_INDEX.setdefault(alias, []).append((field, rank))
+
 # Enhanced field mapping with multiple possible field names
-def extract_field_value(data, possible_names, default="unknown"):
-    """Extract field value from data using multiple possible field names"""
+def extract_field_values(data):
+    """Map every known field name in data onto its response field in a single pass"""
+    values = {}
+    ranks = {}
     if isinstance(data, dict):
-        for name in possible_names:
-            if name in data:
-                value = data[name]
-                if value and value != "unknown" and value != "Unknown":
-                    return value
-    return default
+        for name, value in data.items():
+            if not value or value == "unknown" or value == "Unknown":
+                continue
+            for field, rank in FIELD_INDEX.get(name, ()):
+                if rank < ranks.get(field, len(FIELD_ALIASES[field])):
+                    values[field] = value
+                    ranks[field] = rank
+    return values
+
+# Patterns used to recover basic info from raw model text, in priority order
+COUNTRY_PATTERNS = {
+    "france": ["france", "french", "republique francaise", "république française"],
+    "usa": ["united states", "usa", "us", "american"],
+    "uk": ["united kingdom", "uk", "britain", "british", "england"],
+    "germany": ["germany", "german", "deutschland"],
+    "italy": ["italy", "italian", "italia"],
+    "spain": ["spain", "spanish", "españa"],
+    "canada": ["canada", "canadian"],
+    "australia": ["australia", "australian"],
+    "japan": ["japan", "japanese", "nihon"],
+    "china": ["china", "chinese", "zhongguo"]
+}
+
+DENOMINATION_PATTERNS = {
+    "1 cent": ["1 cent", "one cent", "penny"],
+    "5 cents": ["5 cents", "five cents", "nickel"],
+    "10 cents": ["10 cents", "ten cents", "dime"],
+    "25 cents": ["25 cents", "quarter", "twenty-five cents"],
+    "50 cents": ["50 cents", "half dollar", "fifty cents"],
+    "1 dollar": ["1 dollar", "one dollar", "dollar coin"],
+    "1 euro": ["1 euro", "one euro"],
+    "2 euros": ["2 euros", "two euros"],
+    "5 euros": ["5 euros", "five euros"],
+    "10 euros": ["10 euros", "ten euros"],
+    "20 euros": ["20 euros", "twenty euros"],
+    "50 euros": ["50 euros", "fifty euros"],
+    "1 pound": ["1 pound", "one pound", "pound sterling"],
+    "2 pounds": ["2 pounds", "two pounds"],
+    "1 yen": ["1 yen", "one yen"],
+    "5 yen": ["5 yen", "five yen"],
+    "10 yen": ["10 yen", "ten yen"],
+    "50 yen": ["50 yen", "fifty yen"],
+    "100 yen": ["100 yen", "hundred yen"]
+}
+
+COMPOSITION_PATTERNS = {
+    "copper": ["copper", "cu"],
+    "bronze": ["bronze"],
+    "brass": ["brass"],
+    "silver": ["silver", "ag"],
+    "gold": ["gold", "au"],
+    "nickel": ["nickel", "ni"],
+    "zinc": ["zinc", "zn"],
+    "aluminum": ["aluminum", "aluminium", "al"],
+    "steel": ["steel", "iron"]
+}
+
+TEXT_PATTERN_GROUPS = {
+    "country": COUNTRY_PATTERNS,
+    "denomination": DENOMINATION_PATTERNS,
+    "composition": COMPOSITION_PATTERNS
+}
+
+# Each distinct pattern mapped to every (category, label) it signals, so a
+# pattern shared between categories (e.g. "nickel") is only searched once
+TEXT_PATTERN_LABELS = {}
+for category, patterns_by_label in TEXT_PATTERN_GROUPS.items():
+    for label, patterns in patterns_by_label.items():
+        for pattern in patterns:
+            TEXT_PATTERN_LABELS.setdefault(pattern, []).append((category, label))
+
+# Build a single Aho-Corasick automaton over every pattern so the raw text
+# is scanned once instead of once per pattern
+def build_text_matcher():
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for pattern, labels in TEXT_PATTERN_LABELS.items():
+        automaton.add_word(pattern, tuple(labels))
+    automaton.make_automaton()
+    return automaton
+
+TEXT_MATCHER = build_text_matcher()
+
+def match_text_patterns(text_lower):
+    """Return the set of matched labels for each pattern category"""
+    matches = {category: set() for category in TEXT_PATTERN_GROUPS}
+    if TEXT_MATCHER is not None:
+        for _, labels in TEXT_MATCHER.iter(text_lower):
+            for category, label in labels:
+                matches[category].add(label)
+        return matches
+    
+    # Fallback when pyahocorasick is not installed
+    for pattern, labels in TEXT_PATTERN_LABELS.items():
+        if pattern in text_lower:
+            for category, label in labels:
+                matches[category].add(label)
+    return matches
 
 def enhance_with_text_analysis(raw_text, response):
     """Extract basic information from raw text when JSON parsing fails"""
-    text_lower = raw_text.lower()
+    matches = match_text_patterns(raw_text.lower())
+    basic_info = response["coin_analysis"]["basic_info"]
     
     # Try to identify country from common patterns
-    country_patterns = {
-        "france": ["france", "french", "republique francaise", "république française"],
-        "usa": ["united states", "usa", "us", "american"],
-        "uk": ["united kingdom", "uk", "britain", "british", "england"],
-        "germany": ["germany", "german", "deutschland"],
-        "italy": ["italy", "italian", "italia"],
-        "spain": ["spain", "spanish", "españa"],
-        "canada": ["canada", "canadian"],
-        "australia": ["australia", "australian"],
-        "japan": ["japan", "japanese", "nihon"],
-        "china": ["china", "chinese", "zhongguo"]
-    }
-    
-    for country, patterns in country_patterns.items():
-        if any(pattern in text_lower for pattern in patterns):
-            response["coin_analysis"]["basic_info"]["country"] = country.title()
+    for country in COUNTRY_PATTERNS:
+        if country in matches["country"]:
+            basic_info["country"] = country.title()
             break
     
     # Try to identify denomination from common patterns
-    denomination_patterns = {
-        "1 cent": ["1 cent", "one cent", "penny"],
-        "5 cents": ["5 cents", "five cents", "nickel"],
-        "10 cents": ["10 cents", "ten cents", "dime"],
-        "25 cents": ["25 cents", "quarter", "twenty-five cents"],
-        "50 cents": ["50 cents", "half dollar", "fifty cents"],
-        "1 dollar": ["1 dollar", "one dollar", "dollar coin"],
-        "1 euro": ["1 euro", "one euro"],
-        "2 euros": ["2 euros", "two euros"],
-        "5 euros": ["5 euros", "five euros"],
-        "10 euros": ["10 euros", "ten euros"],
-        "20 euros": ["20 euros", "twenty euros"],
-        "50 euros": ["50 euros", "fifty euros"],
-        "1 pound": ["1 pound", "one pound", "pound sterling"],
-        "2 pounds": ["2 pounds", "two pounds"],
-        "1 yen": ["1 yen", "one yen"],
-        "5 yen": ["5 yen", "five yen"],
-        "10 yen": ["10 yen", "ten yen"],
-        "50 yen": ["50 yen", "fifty yen"],
-        "100 yen": ["100 yen", "hundred yen"]
-    }
-    
-    for denomination, patterns in denomination_patterns.items():
-        if any(pattern in text_lower for pattern in patterns):
-            response["coin_analysis"]["basic_info"]["denomination"] = denomination
+    for denomination in DENOMINATION_PATTERNS:
+        if denomination in matches["denomination"]:
+            basic_info["denomination"] = denomination
             break
     
     # Try to identify composition from common patterns
-    composition_patterns = {
-        "copper": ["copper", "cu"],
-        "bronze": ["bronze"],
-        "brass": ["brass"],
-        "silver": ["silver", "ag"],
-        "gold": ["gold", "au"],
-        "nickel": ["nickel", "ni"],
-        "zinc": ["zinc", "zn"],
-        "aluminum": ["aluminum", "aluminium", "al"],
-        "steel": ["steel", "iron"]
-    }
-    
-    found_compositions = []
-    for composition, patterns in composition_patterns.items():
-        if any(pattern in text_lower for pattern in patterns):
-            found_compositions.append(composition)
-    
-    if found_compositions:
-        response["coin_analysis"]["basic_info"]["composition"] = ", ".join(found_compositions)
+    # Joined in pattern order so the result doesn't depend on where they appear in the text
+    if matches["composition"]:
+        basic_info["composition"] = ", ".join(
+            c for c in COMPOSITION_PATTERNS if c in matches["composition"]
+        )
     
     return response
 
-# Custom JSON encoder for better serialization
-class EnhancedJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
-
 # Create a beautiful response structure
 def create_beautiful_response(parsed_analysis, model_used, filename, image_size):
     # Enhanced field extraction with multiple possible field names
-    released_year = extract_field_value(parsed_analysis, [
-        "year first released", "year", "release_year", "mint_year", "first_released", "issued_year"
-    ])
-    
-    country = extract_field_value(parsed_analysis, [
-        "country", "nation", "origin", "issuing_country"
-    ])
-    
-    denomination = extract_field_value(parsed_analysis, [
-        "denomination", "value", "face_value", "coin_value", "monetary_value"
-    ])
-    
-    composition = extract_field_value(parsed_analysis, [
-        "composition", "material", "metal", "alloy", "composition_material"
-    ])
-    
-    collector_value = extract_field_value(parsed_analysis, [
-        "value", "collector_value", "market_value", "estimated_value", "worth"
-    ])
-    
-    rarity = extract_field_value(parsed_analysis, [
-        "rarity", "scarcity", "availability", "rarity_level"
-    ])
-    
-    description = extract_field_value(parsed_analysis, [
-        "description", "description_text", "coin_description", "details"
-    ], "No description available")
-    
-    historical_context = extract_field_value(parsed_analysis, [
-        "historical_context", "history", "historical_background", "context"
-    ], "No historical context available")
+    fields = extract_field_values(parsed_analysis)
+    # The response timestamp and processing time describe the same instant
+    now = datetime.now().isoformat()
     
     # Extract technical details
     technical_details = {}
@@ -206,37 +445,599 @@ def create_beautiful_response(parsed_analysis, model_used, filename, image_size)
     
     return {
         "success": True,
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": now,
         "coin_analysis": {
             "basic_info": {
-                "released_year": released_year,
-                "country": country,
-                "denomination": denomination,
-                "composition": composition
+                "released_year": fields.get("released_year", "unknown"),
+                "country": fields.get("country", "unknown"),
+                "denomination": fields.get("denomination", "unknown"),
+                "composition": fields.get("composition", "unknown")
             },
             "value_assessment": {
-                "collector_value": collector_value,
-                "rarity": rarity
+                "collector_value": fields.get("collector_value", "unknown"),
+                "rarity": fields.get("rarity", "unknown")
             },
-            "description": description,
-            "historical_context": historical_context,
+            "description": fields.get("description", "No description available"),
+            "historical_context": fields.get("historical_context", "No historical context available"),
             "technical_details": technical_details
         },
         "metadata": {
             "model_used": model_used,
             "image_filename": filename,
             "image_size_bytes": image_size,
-            "processing_time": datetime.now().isoformat()
+            "processing_time": now
+        }
+    }
+
+class AnalysisCache:
+    """Small LRU cache whose entries expire after a fixed time-to-live"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+class AsyncTokenBucket:
+    """Token bucket refilled continuously over a minute; a rate of 0 never blocks"""
+    
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60.0
+        self._tokens = float(rate_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        amount = min(amount, self.capacity)
+        # Waiters are served in order so a large request is not starved by small ones
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+def analysis_cache_key(image_hash):
+    """Cache key for an image's analysis under the current deployment and prompt"""
+    return (image_hash, AZURE_OPENAI_DEPLOYMENT_NAME, PROMPT_VERSION)
+
+def restamp_response(coin_response, filename):
+    """Copy a cached response with this request's filename and timestamps"""
+    now = datetime.now().isoformat()
+    return {
+        **coin_response,
+        "timestamp": now,
+        "metadata": {
+            **coin_response.get("metadata", {}),
+            "image_filename": filename,
+            "processing_time": now
+        }
+    }
+
+def require_azure_config():
+    """Fail the request early when Azure OpenAI is not configured"""
+    if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT:
+        raise HTTPException(
+            status_code=500, 
+            detail="Azure OpenAI configuration not complete. Please set AZURE_OPENAI_API_KEY and AZURE_OPENAI_ENDPOINT"
+        )
+
+def validate_image(image):
+    """Reject uploads that are not images in a format Azure OpenAI accepts"""
+    if not image.content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=400, 
+            detail="File must be an image"
+        )
+    if image.content_type not in IMAGE_MIME_EXTENSIONS:
+        raise HTTPException(
+            status_code=415,
+            detail="Unsupported image type. Use JPEG, PNG, GIF or WebP"
+        )
+    # Starlette records the spooled size, so oversized uploads fail before any read
+    if image.size is not None and image.size > MAX_IMAGE_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Image too large (max {MAX_IMAGE_BYTES} bytes)"
+        )
+
+def image_placeholder(index):
+    return f"__IMAGE_BASE64_{index}__"
+
+def image_part(content_type, index):
+    """Build an image_url content part whose base64 data is spliced in later"""
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/{IMAGE_MIME_EXTENSIONS[content_type]};base64,{image_placeholder(index)}"
+        }
+    }
+
+def image_url_part(url):
+    """Build an image_url content part pointing at an HTTPS-reachable image"""
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": url
+        }
+    }
+
+def build_payload(user_content):
+    """Build the chat completion payload around the coin analysis system prompt"""
+    # Only the user message varies per request; the rest is shared and never mutated
+    return {
+        **PAYLOAD_BASE,
+        "messages": [
+            SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": user_content
+            }
+        ]
+    }
+
+def is_supported_image(header):
+    """Check the leading bytes of an upload against known image signatures"""
+    return (
+        header.startswith(b"\xff\xd8\xff")  # JPEG
+        or header.startswith(b"\x89PNG\r\n\x1a\n")
+        or header.startswith((b"GIF87a", b"GIF89a"))
+        or (header.startswith(b"RIFF") and header[8:12] == b"WEBP")
+    )
+
+async def read_image(image):
+    """Read an upload in chunks up to MAX_IMAGE_BYTES, returning its bytes and content hash"""
+    data = bytearray()
+    digest = hashlib.blake2b(digest_size=16)
+    sniffed = False
+    while chunk := await image.read(IMAGE_READ_CHUNK_SIZE):
+        data += chunk
+        if len(data) > MAX_IMAGE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Image too large (max {MAX_IMAGE_BYTES} bytes)"
+            )
+        # Check the signature as soon as we have it rather than trusting content_type
+        if not sniffed and len(data) >= 12:
+            if not is_supported_image(data[:12]):
+                raise HTTPException(
+                    status_code=400,
+                    detail="File must be an image"
+                )
+            sniffed = True
+        digest.update(chunk)
+    if not sniffed and not is_supported_image(data[:12]):
+        raise HTTPException(
+            status_code=400,
+            detail="File must be an image"
+        )
+    return data, digest.hexdigest()
+
+def shrink_with_vips(image_data):
+    """Downscale with libvips, which decodes JPEGs at reduced size and is much faster than Pillow"""
+    im = pyvips.Image.thumbnail_buffer(bytes(image_data), IMAGE_MAX_EDGE, size="down")
+    return im.write_to_buffer(".jpg[Q=85,strip,optimize_coding]")
+
+def shrink_with_pillow(image_data):
+    with Image.open(io.BytesIO(image_data)) as im:
+        # Apply the EXIF orientation first, since re-encoding drops the tag
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        out = io.BytesIO()
+        im.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+    return out.getvalue()
+
+def shrink_image(image_data):
+    """Downscale and recompress an image to JPEG, or return None if it cannot be decoded"""
+    try:
+        if pyvips is not None:
+            shrunk = shrink_with_vips(image_data)
+        else:
+            shrunk = shrink_with_pillow(image_data)
+    except Exception as e:
+        logger.warning(f"Could not downscale image, sending original: {e}")
+        return None
+    return shrunk if len(shrunk) < len(image_data) else None
+
+async def downscale_image(pool, image_data, content_type):
+    """Downscale oversized images on the given thread pool, returning the bytes to send"""
+    if (pyvips is not None or Image is not None) and len(image_data) > IMAGE_SHRINK_THRESHOLD:
+        shrunk = await asyncio.get_running_loop().run_in_executor(pool, shrink_image, image_data)
+        if shrunk is not None:
+            return shrunk, "image/jpeg"
+    return image_data, content_type
+
+async def encode_image(pool, image_data, content_type):
+    """Downscale oversized images and base64-encode them on the given thread pool"""
+    image_data, content_type = await downscale_image(pool, image_data, content_type)
+    encoded = await asyncio.get_running_loop().run_in_executor(pool, base64.b64encode, image_data)
+    return encoded, content_type
+
+async def prepare_image(state, read_slots, image):
+    """Read one batch upload and look up its cached analysis, or downscale and encode it.
+    
+    Returns (cached response, base64, content type, size, hash), with either the
+    cached response or the base64 set; the raw upload is released on return.
+    """
+    async with read_slots:
+        image_data, image_hash = await read_image(image)
+        image_size = len(image_data)
+        cached_response = state.analysis_cache.get(analysis_cache_key(image_hash))
+        if cached_response is not None:
+            return cached_response, None, None, image_size, image_hash
+        encoded, content_type = await encode_image(state.thread_pool, image_data, image.content_type)
+        return None, encoded, content_type, image_size, image_hash
+
+def upload_image_blob(container, image_data, content_type):
+    """Upload an image to Blob Storage, returning its name and a short-lived read URL"""
+    blob_name = f"{uuid.uuid4().hex}.{IMAGE_MIME_EXTENSIONS[content_type]}"
+    blob = container.get_blob_client(blob_name)
+    blob.upload_blob(
+        bytes(image_data),
+        overwrite=True,
+        content_settings=ContentSettings(content_type=content_type)
+    )
+    sas = generate_blob_sas(
+        account_name=container.account_name,
+        container_name=container.container_name,
+        blob_name=blob_name,
+        account_key=container.credential.account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.utcnow() + timedelta(seconds=BLOB_SAS_TTL)
+    )
+    return blob_name, f"{blob.url}?{sas}"
+
+def delete_image_blob(container, blob_name):
+    """Remove an uploaded image once Azure OpenAI has read it"""
+    try:
+        container.delete_blob(blob_name)
+    except Exception as e:
+        logger.warning(f"Could not delete image blob {blob_name}: {e}")
+
+def schedule_blob_delete(state, container, blob_name):
+    """Delete an uploaded image in the background, holding the task until it finishes"""
+    task = asyncio.create_task(asyncio.to_thread(delete_image_blob, container, blob_name))
+    state.blob_deletes.add(task)
+    task.add_done_callback(state.blob_deletes.discard)
+
+def build_request_body(payload, encoded_images):
+    """Serialize the payload once and splice the base64 images into it"""
+    rest = orjson.dumps(payload)
+    parts = []
+    for index, encoded in enumerate(encoded_images):
+        before, rest = rest.split(image_placeholder(index).encode(), 1)
+        parts += (before, encoded)
+    parts.append(rest)
+    return b"".join(parts)
+
+async def post_to_azure(client, headers, body):
+    """POST to Azure OpenAI, retrying connection failures and bounding the response size
+    
+    Returns the response and its (decoded) body.
+    """
+    for attempt in range(AZURE_CONNECT_ATTEMPTS):
+        try:
+            response = await client.send(
+                client.build_request("POST", AZURE_OPENAI_API_URL, headers=headers, content=body),
+                stream=True
+            )
+            break
+        except (httpx.ConnectTimeout, httpx.PoolTimeout):
+            if attempt == AZURE_CONNECT_ATTEMPTS - 1:
+                raise
+            logger.warning(f"Azure OpenAI connection attempt {attempt + 1} timed out, retrying")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    # http2=True only offers HTTP/2; ALPN decides, so log what Azure actually negotiated
+    logger.debug("Azure OpenAI responded over %s", response.http_version)
+    
+    # Reject oversized responses before reading the body
+    content_length = response.headers.get("content-length")
+    if content_length and int(content_length) > AZURE_MAX_RESPONSE_BYTES:
+        await response.aclose()
+        logger.error(f"Azure OpenAI response too large: {content_length} bytes")
+        raise HTTPException(
+            status_code=502,
+            detail="Azure OpenAI response too large"
+        )
+    
+    # Content-Length is absent for chunked replies and counts compressed bytes,
+    # so enforce the cap on the decoded body as it arrives
+    content = bytearray()
+    try:
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if len(content) > AZURE_MAX_RESPONSE_BYTES:
+                logger.error(f"Azure OpenAI response exceeded {AZURE_MAX_RESPONSE_BYTES} bytes")
+                raise HTTPException(
+                    status_code=502,
+                    detail="Azure OpenAI response too large"
+                )
+    finally:
+        await response.aclose()
+    return response, bytes(content)
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter: ~1s, 2s, 4s, ... capped at AZURE_MAX_RETRY_DELAY"""
+    return min(AZURE_MAX_RETRY_DELAY, 2 ** attempt + random.uniform(0, 1))
+
+def retry_after_seconds(response, default):
+    """Read how long Azure asked us to back off, preferring the millisecond header.
+    
+    The delay is capped at AZURE_MAX_RETRY_DELAY so a large header can't hold
+    the request (and its concurrency slot) for minutes.
+    """
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        value = response.headers.get(header)
+        if value:
+            try:
+                return min(AZURE_MAX_RETRY_DELAY, max(0.0, float(value) * scale))
+            except ValueError:
+                pass
+    return default
+
+async def request_analysis(state, payload, encoded_images):
+    """Send a payload to Azure OpenAI and return the raw text of the model's reply and its finish reason"""
+    headers = {
+        "api-key": AZURE_OPENAI_API_KEY,
+        "Content-Type": "application/json"
+    }
+    
+    # Make request to Azure OpenAI, pacing to the deployment's quota and waiting
+    # for a free slot first; rate limits and transient server errors are retried
+    # with backoff, reusing the already-encoded body
+    body = build_request_body(payload, encoded_images)
+    for attempt in range(AZURE_MAX_ATTEMPTS):
+        await state.request_bucket.acquire()
+        await state.token_bucket.acquire(payload["max_tokens"])
+        async with state.azure_semaphore:
+            response, content = await post_to_azure(state.http_client, headers, body)
+        if response.status_code not in AZURE_RETRY_STATUS_CODES or attempt == AZURE_MAX_ATTEMPTS - 1:
+            break
+        delay = retry_after_seconds(response, default=backoff_delay(attempt))
+        logger.warning(
+            f"Azure OpenAI returned {response.status_code}, retrying in {delay:.1f}s "
+            f"(attempt {attempt + 1} of {AZURE_MAX_ATTEMPTS})"
+        )
+        await asyncio.sleep(delay)
+    
+    if response.status_code != 200:
+        logger.error(f"Azure OpenAI API error: {response.status_code} - {content.decode(errors='replace')}")
+        raise HTTPException(
+            status_code=500,
+            detail="Error communicating with Azure OpenAI API"
+        )
+    
+    azure_response = orjson.loads(content)
+    
+    # Extract the analysis from Azure OpenAI response
+    if "choices" in azure_response and len(azure_response["choices"]) > 0:
+        choice = azure_response["choices"][0]
+        raw_analysis = choice["message"]["content"]
+        logger.debug("Raw GPT response: %.1000s...", raw_analysis)  # Log first 1000 chars
+        return raw_analysis, choice.get("finish_reason")
+    
+    raise HTTPException(
+        status_code=500,
+        detail="Unexpected response format from Azure OpenAI"
+    )
+
+async def open_analysis_stream(state, payload, encoded_images):
+    """Start a streaming Azure OpenAI call and return the open response once it succeeds
+    
+    The caller holds an Azure semaphore slot until the stream ends and must close
+    the response and release the semaphore when done.
+    """
+    headers = {
+        "api-key": AZURE_OPENAI_API_KEY,
+        "Content-Type": "application/json"
+    }
+    
+    # Same pacing and retries as request_analysis, but only until the first byte
+    body = build_request_body(payload, encoded_images)
+    for attempt in range(AZURE_MAX_ATTEMPTS):
+        await state.request_bucket.acquire()
+        await state.token_bucket.acquire(payload["max_tokens"])
+        await state.azure_semaphore.acquire()
+        try:
+            response = await state.http_client.send(
+                state.http_client.build_request("POST", AZURE_OPENAI_API_URL, headers=headers, content=body),
+                stream=True
+            )
+        except BaseException:
+            state.azure_semaphore.release()
+            raise
+        if response.status_code == 200:
+            return response
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+            state.azure_semaphore.release()
+        if response.status_code not in AZURE_RETRY_STATUS_CODES or attempt == AZURE_MAX_ATTEMPTS - 1:
+            break
+        delay = retry_after_seconds(response, default=backoff_delay(attempt))
+        logger.warning(
+            f"Azure OpenAI returned {response.status_code}, retrying in {delay:.1f}s "
+            f"(attempt {attempt + 1} of {AZURE_MAX_ATTEMPTS})"
+        )
+        await asyncio.sleep(delay)
+    
+    logger.error(f"Azure OpenAI API error: {response.status_code} - {response.text}")
+    raise HTTPException(
+        status_code=500,
+        detail="Error communicating with Azure OpenAI API"
+    )
+
+async def stream_deltas(response):
+    """Yield the text fragments of a streaming chat completion as they arrive"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        chunk = orjson.loads(data)
+        # Azure sends content-filter results as chunks with no choices
+        if chunk.get("choices"):
+            content = chunk["choices"][0].get("delta", {}).get("content")
+            if content:
+                yield content
+
+def sse_event(data, event=None):
+    """Format one server-sent event with a JSON data line"""
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + orjson.dumps(data) + b"\n\n"
+
+async def analyze_image_group(state, content_types, encoded_images):
+    """Analyze a group of images in one Azure call, returning one analysis dict per image"""
+    # One user message: the batch instruction followed by every image in order
+    user_content = [
+        {
+            "type": "text",
+            "text": BATCH_INSTRUCTION.format(count=len(encoded_images))
+        }
+    ]
+    for index, content_type in enumerate(content_types):
+        user_content.append(image_part(content_type, index))
+    
+    payload = {
+        **build_payload(user_content),
+        "max_tokens": BATCH_TOKENS_PER_IMAGE * len(encoded_images)
+    }
+    raw_analysis, finish_reason = await request_analysis(state, payload, encoded_images)
+    # A reply cut off at max_tokens can't hold every analysis; fail the group
+    # rather than pass off the missing images as empty results
+    if finish_reason == "length":
+        logger.error(f"Batch reply for {len(encoded_images)} images hit max_tokens")
+        raise HTTPException(
+            status_code=502,
+            detail="Azure OpenAI reply was cut off before every image was analyzed"
+        )
+    
+    parsed_analysis = extract_json(raw_analysis)
+    analyses = parsed_analysis.get("coins") if isinstance(parsed_analysis, dict) else parsed_analysis
+    if not isinstance(analyses, list):
+        logger.warning("Batch response did not contain a list of analyses")
+        analyses = []
+    
+    # Pad or trim to exactly one entry per image; None marks an image the model skipped
+    return [
+        analyses[index] if index < len(analyses) and isinstance(analyses[index], dict) and analyses[index] else None
+        for index in range(len(encoded_images))
+    ]
+
+def batch_error_response(filename, error):
+    """Describe an image whose analysis failed, in place of its result in a batch"""
+    if isinstance(error, HTTPException):
+        detail = error.detail
+    elif isinstance(error, httpx.TimeoutException):
+        detail = "Request timeout - Azure OpenAI API took too long to respond"
+    else:
+        detail = f"Internal server error: {str(error)}"
+    logger.error(f"Batch analysis failed for {filename}: {detail}")
+    return {
+        "success": False,
+        "error": detail,
+        "metadata": {
+            "image_filename": filename
         }
     }
 
+def build_coin_response(parsed_analysis, filename, image_size):
+    """Stamp our metadata onto a model-formatted analysis, or map it onto the response structure"""
+    if isinstance(parsed_analysis, dict) and "coin_analysis" in parsed_analysis:
+        # Update the metadata with current values
+        metadata = parsed_analysis.setdefault("metadata", {})
+        now = datetime.now().isoformat()
+        metadata["model_used"] = AZURE_OPENAI_DEPLOYMENT_NAME
+        metadata["image_filename"] = filename
+        metadata["image_size_bytes"] = image_size
+        metadata["processing_time"] = now
+        parsed_analysis["timestamp"] = now
+        return parsed_analysis
+    
+    return create_beautiful_response(
+        parsed_analysis,
+        AZURE_OPENAI_DEPLOYMENT_NAME,
+        filename,
+        image_size
+    )
+
+def identifies_coin(coin_response):
+    """Whether a response names the coin at all, i.e. its country or denomination is known"""
+    basic_info = coin_response.get("coin_analysis", {}).get("basic_info", {})
+    return not (
+        basic_info.get("country", "unknown") == "unknown"
+        and basic_info.get("denomination", "unknown") == "unknown"
+    )
+
+def analysis_to_response(raw_analysis, filename, image_size):
+    """Turn the model's raw reply for a single coin into the API response structure.
+    
+    Returns the response and whether it is safe to cache, which it is only when
+    the reply parsed into a real analysis rather than a fallback.
+    """
+    parsed_analysis = extract_json(raw_analysis)
+    logger.debug("Parsed analysis: %s", parsed_analysis)
+    cacheable = (
+        isinstance(parsed_analysis, dict)
+        and bool(parsed_analysis)
+        and parsed_analysis.keys() != {"raw"}
+    )
+    
+    # If the response is already in the correct format, return it
+    if isinstance(parsed_analysis, dict) and "coin_analysis" in parsed_analysis:
+        coin_response = build_coin_response(parsed_analysis, filename, image_size)
+        return coin_response, cacheable and identifies_coin(coin_response)
+    
+    # Otherwise, create beautiful, structured response
+    coin_response = create_beautiful_response(
+        parsed_analysis if isinstance(parsed_analysis, dict) else {},
+        AZURE_OPENAI_DEPLOYMENT_NAME,
+        filename,
+        image_size
+    )
+    
+    # If we got mostly "unknown" values, try to extract more information from the raw text
+    if not identifies_coin(coin_response):
+        logger.warning("Most fields are unknown, attempting to extract info from raw text")
+        # Try to extract basic info from the raw text using simple text analysis
+        coin_response = enhance_with_text_analysis(raw_analysis, coin_response)
+        cacheable = False
+    
+    return coin_response, cacheable
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
     return {"message": "Coin Analyzer API is running! 🪙"}
 
 @app.post("/analyze")
-async def analyze_coin(image: UploadFile = File(...)):
+async def analyze_coin(request: Request, image: UploadFile = File(...)):
     """
     Analyze a coin image using OpenAI GPT-4 Vision
     
@@ -246,167 +1047,255 @@ async def analyze_coin(image: UploadFile = File(...)):
     Returns:
         JSON response with coin analysis from GPT-4 Vision
     """
-    if not AZURE_OPENAI_API_KEY or not AZURE_OPENAI_ENDPOINT:
+    require_azure_config()
+    validate_image(image)
+    
+    try:
+        # Read image data
+        image_data, image_hash = await read_image(image)
+        image_size = len(image_data)
+        
+        # Identical uploads reuse the earlier analysis instead of calling Azure again
+        cache_key = analysis_cache_key(image_hash)
+        cached_response = request.app.state.analysis_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info(f"Serving cached analysis for image {image_hash}")
+            return ORJSONResponse(content=restamp_response(cached_response, image.filename))
+        
+        pool = request.app.state.thread_pool
+        image_data, content_type = await downscale_image(pool, image_data, image.content_type)
+        
+        # Hand Azure a signed Blob URL when storage is configured, otherwise inline base64
+        container = request.app.state.blob_container
+        blob_name = None
+        if container is not None:
+            blob_name, image_url = await asyncio.to_thread(
+                upload_image_blob, container, image_data, content_type
+            )
+            user_image = image_url_part(image_url)
+            encoded_images = []
+        else:
+            user_image = image_part(content_type, 0)
+            encoded_images = [
+                await asyncio.get_running_loop().run_in_executor(pool, base64.b64encode, image_data)
+            ]
+        # The raw upload is no longer needed; free it before the request body is built
+        del image_data
+        
+        payload = build_payload([NEWLINE_PART, user_image, NEWLINE_PART])
+        try:
+            raw_analysis, _ = await request_analysis(
+                request.app.state,
+                payload,
+                encoded_images
+            )
+        finally:
+            if blob_name is not None:
+                # Azure is done with the image; delete it off the request path,
+                # whether or not the reply turns into a response
+                schedule_blob_delete(request.app.state, container, blob_name)
+        
+        coin_response, cacheable = analysis_to_response(raw_analysis, image.filename, image_size)
+        
+        if cacheable:
+            request.app.state.analysis_cache.set(cache_key, coin_response)
+        return ORJSONResponse(content=coin_response)
+
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        logger.error("Timeout while communicating with Azure OpenAI API")
         raise HTTPException(
-            status_code=500, 
-            detail="Azure OpenAI configuration not complete. Please set AZURE_OPENAI_API_KEY and AZURE_OPENAI_ENDPOINT"
+            status_code=504,
+            detail="Request timeout - Azure OpenAI API took too long to respond"
         )
-    
-    # Validate file type
-    if not image.content_type.startswith("image/"):
+    except Exception as e:
+        logger.error(f"Error processing image: {str(e)}")
         raise HTTPException(
-            status_code=400, 
-            detail="File must be an image"
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
         )
+
+@app.post("/analyze_stream")
+async def analyze_coin_stream(request: Request, image: UploadFile = File(...)):
+    """
+    Analyze a coin image, streaming the model's reply as server-sent events
+    
+    Args:
+        image: The coin image file (multipart/form-data)
+    
+    Returns:
+        text/event-stream of {"content": ...} fragments, then a "result" event with
+        the same structure as /analyze (or an "error" event)
+    """
+    require_azure_config()
+    validate_image(image)
+    state = request.app.state
     
     try:
-        # Read image data
-        image_data = await image.read()
-        
-        # Prepare the request to Azure OpenAI
-        headers = {
-            "api-key": AZURE_OPENAI_API_KEY,
-            "Content-Type": "application/json",
-            "Azure-OpenAI-Image-Encoding": "base64"  # Required for image_url base64
-        }
+        image_data, image_hash = await read_image(image)
+        image_size = len(image_data)
         
-        # Convert image to base64 for OpenAI API
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+        cache_key = analysis_cache_key(image_hash)
+        cached_response = state.analysis_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info(f"Serving cached analysis for image {image_hash}")
+            return StreamingResponse(
+                iter([sse_event(restamp_response(cached_response, image.filename), "result")]),
+                media_type="text/event-stream"
+            )
         
-        # Create chat prompt with the comprehensive system message from your code
-        chat_prompt = [
-            {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "Analyze an image of a coin and provide detailed information about it following a structured JSON output format.\n\nYour task is to extract and identify relevant information from the image provided, including historical, technical, and value-related details about the coin. The JSON output must strictly adhere to the specified structure and include all fields, even if some values are unknown.\n\n# Steps\n\n1. **Image Analysis**\n   - Examine the image for visual characteristics such as inscriptions, symbols, design elements, and patterns.\n   - Identify visible text, numbers, or symbols to infer the country of origin, denomination, composition, mint mark, and release year.\n\n2. **Infer Historical Context**\n   - Based on the appearance and known symbols, extract the significance of the coin in its national or historical setting.\n   - If possible, describe symbolic representations or notable historical events related to the coin.\n\n3. **Determine Value**\n   - Assess rarity, collector interest, or other factors that may provide insight into the coin's monetary or historical value.\n   - Use contextual clues (e.g., mint mark, visible inscriptions, or styles) to estimate the collector value.\n\n4. **Extract Technical Details**\n   - Note physical specifications such as mint mark, material composition, diameter (in millimeters), and other data inferred from design features.\n\n5. **Compile Metadata**\n   - Add details pertaining to the analysis process, including timestamps, size of the image file, filename, and AI model used.\n\n6. **Present the Data in Predefined JSON Format**\n   - Ensure all fields are included, and default to `\"unknown\"` unless information is reliably inferred.\n\n# Output Format\n\nThe result should adhere strictly to the following JSON structure:\n\n```json\n{\n  \"success\": true,\n  \"timestamp\": \"[ISO 8601 timestamp]\",\n  \"coin_analysis\": {\n    \"basic_info\": {\n      \"released_year\": \"[value or 'unknown']\",\n      \"country\": \"[value or 'unknown']\",\n      \"denomination\": \"[value or 'unknown']\",\n      \"composition\": \"[value or 'unknown']\"\n    },\n    \"value_assessment\": {\n      \"collector_value\": \"[value or 'unknown']\",\n      \"rarity\": \"[value or 'unknown']\"\n    },\n    \"description\": \"[Descriptive narrative relevant to the coin's artistic and symbolic features]\",\n    \"historical_context\": \"[Historical or cultural context relevant to the coin]\",\n    \"technical_details\": {\n      \"mint_mark\": \"[value or 'unknown']\",\n      \"diameter_mm\": \"[value or 'unknown']\",\n      \"composition\": \"[value or 'unknown']\"\n    }\n  },\n  \"metadata\": {\n    \"model_used\": \"[AI model name]\",\n    \"image_filename\": \"[image filename]\",\n    \"image_size_bytes\": \"[size in bytes]\",\n    \"processing_time\": \"[ISO 8601 timestamp]\"\n  }\n}\n```\n\n# Notes\n\n- **Fallback Values**: If information cannot be confidently recovered from the image, provide `\"unknown\"` but apply logical deductions where practical.  \n- **Consistency**: Ensure filenames, file size, and analysis timestamps match the input data provided.  \n- **Attention to Detail**: Provide comprehensive descriptions and avoid overly generic statements in historical and artistic contexts.  \n- **ISO 8601 Compliance**: Ensure all timestamps are in the ISO 8601 format for consistency and standardization."
-                    }
-                ]
-            },
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": "\n"
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/{image.content_type.split('/')[-1]};base64,{image_base64}"
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": "\n"
-                    }
-                ]
-            }
-        ]
+        encoded, content_type = await encode_image(state.thread_pool, image_data, image.content_type)
+        del image_data
         
         payload = {
-            "messages": chat_prompt,
-            "max_tokens": 6553,
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "frequency_penalty": 0,
-            "presence_penalty": 0,
-            "stop": None,
-            "stream": False
+            **build_payload([NEWLINE_PART, image_part(content_type, 0), NEWLINE_PART]),
+            "stream": True
         }
+        # Open the stream before responding so Azure errors still get a proper status code
+        response = await open_analysis_stream(state, payload, [encoded])
+    
+    except HTTPException:
+        raise
+    except httpx.TimeoutException:
+        logger.error("Timeout while communicating with Azure OpenAI API")
+        raise HTTPException(
+            status_code=504,
+            detail="Request timeout - Azure OpenAI API took too long to respond"
+        )
+    except Exception as e:
+        logger.error(f"Error processing image: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Internal server error: {str(e)}"
+        )
+    
+    released = False
+    
+    async def release_stream():
+        # Runs from the generator and again as a background task, which Starlette
+        # also calls when the client disconnects before the body is iterated
+        nonlocal released
+        if released:
+            return
+        released = True
+        state.azure_semaphore.release()
+        await response.aclose()
+    
+    async def events():
+        fragments = []
+        try:
+            async for content in stream_deltas(response):
+                fragments.append(content)
+                yield sse_event({"content": content})
+            raw_analysis = "".join(fragments)
+            logger.debug("Raw GPT response: %.1000s...", raw_analysis)
+            coin_response, cacheable = analysis_to_response(raw_analysis, image.filename, image_size)
+            if cacheable:
+                state.analysis_cache.set(cache_key, coin_response)
+            yield sse_event(coin_response, "result")
+        except Exception as e:
+            # Headers are already sent, so report the failure in the stream itself
+            logger.error(f"Error streaming analysis: {str(e)}")
+            yield sse_event({"detail": f"Internal server error: {str(e)}"}, "error")
+        finally:
+            await release_stream()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        background=BackgroundTask(release_stream)
+    )
+
+@app.post("/analyze_batch")
+async def analyze_batch(request: Request, images: List[UploadFile] = File(...)):
+    """
+    Analyze several coin images with a single GPT-4 Vision request
+    
+    Args:
+        images: The coin image files (multipart/form-data, repeated "images" field)
+    
+    Returns:
+        JSON response with one coin analysis per image, in upload order
+    """
+    require_azure_config()
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {BATCH_MAX_IMAGES} images can be analyzed per batch"
+        )
+    for image in images:
+        validate_image(image)
+    
+    try:
+        # At most THREAD_POOL_WORKERS raw uploads are held at once; each is
+        # released as soon as it is encoded
+        read_slots = asyncio.Semaphore(THREAD_POOL_WORKERS)
+        prepared = await asyncio.gather(*(
+            prepare_image(request.app.state, read_slots, image) for image in images
+        ))
+        cache = request.app.state.analysis_cache
         
-        # Make request to Azure OpenAI
-        async with httpx.AsyncClient(timeout=90.0) as client:
-            response = await client.post(
-                AZURE_OPENAI_API_URL,
-                headers=headers,
-                json=payload
+        # Serve re-uploaded images from the cache and only send the rest to Azure
+        results = [None] * len(images)
+        pending = []
+        encoded_images = []
+        for index, (image, prepared_image) in enumerate(zip(images, prepared)):
+            cached_response, encoded, content_type, _, _ = prepared_image
+            if cached_response is not None:
+                results[index] = restamp_response(cached_response, image.filename)
+            else:
+                pending.append(index)
+                encoded_images.append((encoded, content_type))
+        
+        # Send the images in groups, concurrently, bounded by the Azure semaphore
+        groups = [
+            range(start, min(start + BATCH_IMAGES_PER_REQUEST, len(pending)))
+            for start in range(0, len(pending), BATCH_IMAGES_PER_REQUEST)
+        ]
+        # A failed group only fails its own images; the rest of the batch is still returned
+        group_analyses = await asyncio.gather(*(
+            analyze_image_group(
+                request.app.state,
+                [encoded_images[position][1] for position in group],
+                [encoded_images[position][0] for position in group]
             )
-            
-            if response.status_code != 200:
-                logger.error(f"Azure OpenAI API error: {response.status_code} - {response.text}")
-                raise HTTPException(
-                    status_code=500,
-                    detail="Error communicating with Azure OpenAI API"
-                )
-            
-            azure_response = response.json()
-            
-            # Extract the analysis from Azure OpenAI response
-            if "choices" in azure_response and len(azure_response["choices"]) > 0:
-                raw_analysis = azure_response["choices"][0]["message"]["content"]
-                logger.info(f"Raw GPT response: {raw_analysis[:1000]}...")  # Log first 1000 chars
-                
-                # Try to parse the JSON response directly
-                try:
-                    parsed_analysis = json.loads(raw_analysis)
-                    logger.info(f"Parsed analysis: {parsed_analysis}")
-                    
-                    # If the response is already in the correct format, return it
-                    if isinstance(parsed_analysis, dict) and "coin_analysis" in parsed_analysis:
-                        # Update the metadata with current values
-                        parsed_analysis["metadata"]["model_used"] = AZURE_OPENAI_DEPLOYMENT_NAME
-                        parsed_analysis["metadata"]["image_filename"] = image.filename
-                        parsed_analysis["metadata"]["image_size_bytes"] = len(image_data)
-                        parsed_analysis["metadata"]["processing_time"] = datetime.now().isoformat()
-                        parsed_analysis["timestamp"] = datetime.now().isoformat()
-                        
-                        return JSONResponse(
-                            content=parsed_analysis,
-                            status_code=200,
-                            headers={"Content-Type": "application/json"}
-                        )
-                    
-                    # Otherwise, create beautiful, structured response
-                    beautiful_response = create_beautiful_response(
-                        parsed_analysis, 
-                        AZURE_OPENAI_DEPLOYMENT_NAME, 
-                        image.filename, 
-                        len(image_data)
-                    )
-                    
-                    # If we got mostly "unknown" values, try to extract more information from the raw text
-                    if (beautiful_response["coin_analysis"]["basic_info"]["country"] == "unknown" and 
-                        beautiful_response["coin_analysis"]["basic_info"]["denomination"] == "unknown"):
-                        logger.warning("Most fields are unknown, attempting to extract info from raw text")
-                        # Try to extract basic info from the raw text using simple text analysis
-                        enhanced_response = enhance_with_text_analysis(raw_analysis, beautiful_response)
-                        return JSONResponse(
-                            content=enhanced_response,
-                            status_code=200,
-                            headers={"Content-Type": "application/json"}
-                        )
-                    
-                    return JSONResponse(
-                        content=beautiful_response,
-                        status_code=200,
-                        headers={"Content-Type": "application/json"}
-                    )
-                    
-                except json.JSONDecodeError:
-                    # If direct JSON parsing fails, try to extract JSON from the response
-                    parsed_analysis = extract_json(raw_analysis)
-                    logger.info(f"Extracted analysis: {parsed_analysis}")
-                    
-                    beautiful_response = create_beautiful_response(
-                        parsed_analysis, 
-                        AZURE_OPENAI_DEPLOYMENT_NAME, 
-                        image.filename, 
-                        len(image_data)
-                    )
-                    
-                    return JSONResponse(
-                        content=beautiful_response,
-                        status_code=200,
-                        headers={"Content-Type": "application/json"}
+            for group in groups
+        ), return_exceptions=True)
+        
+        failed = 0
+        for group, analyses in zip(groups, group_analyses):
+            for position in group:
+                index = pending[position]
+                if isinstance(analyses, BaseException):
+                    results[index] = batch_error_response(images[index].filename, analyses)
+                    failed += 1
+                    continue
+                analysis = analyses[position - group.start]
+                if analysis is None:
+                    results[index] = batch_error_response(
+                        images[index].filename,
+                        HTTPException(status_code=502, detail="Azure OpenAI returned no analysis for this image")
                     )
-            else:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Unexpected response format from Azure OpenAI"
-                )
-                    
+                    failed += 1
+                    continue
+                _, _, _, image_size, image_hash = prepared[index]
+                coin_response = build_coin_response(analysis, images[index].filename, image_size)
+                # Same rule as /analyze: don't cache a reply that didn't identify the coin
+                if identifies_coin(coin_response):
+                    cache.set(analysis_cache_key(image_hash), coin_response)
+                results[index] = coin_response
+        
+        return ORJSONResponse(content={
+            "success": failed < len(results),
+            "timestamp": datetime.now().isoformat(),
+            "count": len(results),
+            "failed": failed,
+            "results": results
+        })
+    
+    except HTTPException:
+        raise
     except httpx.TimeoutException:
         logger.error("Timeout while communicating with Azure OpenAI API")
         raise HTTPException(
@@ -414,7 +1303,7 @@ async def analyze_coin(image: UploadFile = File(...)):
             detail="Request timeout - Azure OpenAI API took too long to respond"
         )
     except Exception as e:
-        logger.error(f"Error processing image: {str(e)}")
+        logger.error(f"Error processing images: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"Internal server error: {str(e)}"
@@ -447,5 +1336,13 @@ async def debug_info():
     }
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    # Workers need an import string; each one builds its own client, semaphore and cache
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        loop="uvloop",
+        http="httptools",
+        log_level="info"
+    ) 
\ No newline at end of file
@@ -5,8 +5,6 @@ Test script for Azure OpenAI integration with Entra ID authentication
 
 import os
 import base64
-from openai import AzureOpenAI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -14,6 +12,9 @@ load_dotenv()
 
 def test_azure_openai_connection():
     """Test the Azure OpenAI connection with Entra ID authentication"""
+    # The SDKs are heavy; only pay for them when the test actually runs
+    from openai import AzureOpenAI
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
     
     endpoint = os.getenv("ENDPOINT_URL", "https://copperzync.openai.azure.com/")
     deployment = os.getenv("DEPLOYMENT_NAME", "gpt-4o")
@@ -5,91 +5,322 @@ This simulates the Render deployment environment
 """
 
 import os
-import base64
-from openai import AzureOpenAI
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from dotenv import load_dotenv
+import re
+import sys
+import asyncio
+import socket
+import threading
+import time
+from urllib.parse import urlparse
 
-# Load environment variables
-load_dotenv()
+def import_sdks():
+    """Import the OpenAI and Azure identity SDKs, which pull in hundreds of modules"""
+    import openai
+    import azure.identity
 
-def test_azure_openai_with_env():
-    """Test the Azure OpenAI connection using environment variables"""
-    
-    endpoint = os.getenv("ENDPOINT_URL", "https://copperzync.openai.azure.com/")
-    deployment = os.getenv("DEPLOYMENT_NAME", "gpt-4o")
+# Started when the script runs so the slow SDK imports overlap with reading
+# .env and the banner; anything that needs them calls wait_for_sdks first
+sdk_import = threading.Thread(target=import_sdks, daemon=True)
+
+def wait_for_sdks():
+    """Wait for the background SDK imports, if they were started"""
+    if sdk_import.ident is not None:
+        sdk_import.join()
+
+# Messages are collected and written in one go at exit instead of one
+# write (and flush, on a TTY) per line
+OUTPUT = []
+
+def say(message):
+    """Queue a line of output"""
+    OUTPUT.append(message)
+
+def flush_output():
+    """Write everything collected so far to stdout with a single write"""
+    if OUTPUT:
+        sys.stdout.write("\n".join(OUTPUT) + "\n")
+        sys.stdout.flush()
+        OUTPUT.clear()
+
+def parse_env_value(value):
+    """Unquote a .env value, or drop its trailing comment, as python-dotenv does"""
+    value = value.strip()
+    if value[:1] in ("'", '"'):
+        end = value.find(value[0], 1)
+        if end != -1:
+            return value[1:end]
+    return re.split(r"\s+#", value, maxsplit=1)[0].strip()
+
+def load_env_file(path=".env"):
+    """Copy KEY=value lines from a .env file into os.environ, keeping values already set"""
+    if not os.path.exists(path):
+        return
+    with open(path) as env_file:
+        for line in env_file:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, _, value = line.partition("=")
+            key = key.removeprefix("export ").strip()
+            os.environ.setdefault(key, parse_env_value(value))
+
+# Filled in by load_settings, once at startup rather than on every check
+ENDPOINT = None
+DEPLOYMENT = None
+AZURE_CLIENT_ID = None
+AZURE_CLIENT_SECRET = None
+AZURE_TENANT_ID = None
+SERVICE_PRINCIPAL_CONFIGURED = False
+
+def load_settings():
+    """Load .env and read the endpoint and service principal settings"""
+    global ENDPOINT, DEPLOYMENT, AZURE_CLIENT_ID, AZURE_CLIENT_SECRET, AZURE_TENANT_ID
+    global SERVICE_PRINCIPAL_CONFIGURED
+    # A few plain KEY=value lines don't need python-dotenv
+    load_env_file()
+    ENDPOINT = os.getenv("ENDPOINT_URL", "https://copperzync.openai.azure.com/")
+    DEPLOYMENT = os.getenv("DEPLOYMENT_NAME", "gpt-4o")
+    AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID")
+    AZURE_CLIENT_SECRET = os.getenv("AZURE_CLIENT_SECRET")
+    AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
+    SERVICE_PRINCIPAL_CONFIGURED = bool(AZURE_CLIENT_ID and AZURE_CLIENT_SECRET and AZURE_TENANT_ID)
+
+TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+# Tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_SKEW = 300
+
+# Service principal tokens are also kept in an on-disk cache (under
+# ~/.IdentityService) so a restarted process can skip the token endpoint
+TOKEN_CACHE_NAME = "copperzync"
+
+class CachedTokenProvider:
+    """Bearer token provider that reuses a token until it is close to expiry"""
     
-    # Check for service principal environment variables
-    client_id = os.getenv("AZURE_CLIENT_ID")
-    client_secret = os.getenv("AZURE_CLIENT_SECRET")
-    tenant_id = os.getenv("AZURE_TENANT_ID")
+    def __init__(self, scope):
+        self.credential = None
+        self.scope = scope
+        self.token = None
+        # Concurrent probes wait for one fetch instead of each starting their own
+        self.lock = asyncio.Lock()
     
-    print(f"Testing connection to: {endpoint}")
-    print(f"Using deployment: {deployment}")
-    print(f"Service Principal configured: {bool(client_id and client_secret and tenant_id)}")
+    async def __call__(self):
+        async with self.lock:
+            # Built on first use so the SDK imports can finish in the background.
+            # Building it and fetching tokens block (the CLI credential runs a
+            # subprocess), so both run in a thread to keep the event loop free
+            if self.credential is None:
+                self.credential = await asyncio.to_thread(build_credential)
+            # DefaultAzureCredential doesn't cache tokens for developer credentials
+            # like the Azure CLI, so every fetch would walk the whole chain again
+            if self.token is None or self.token.expires_on - time.time() <= TOKEN_REFRESH_SKEW:
+                self.token = await asyncio.to_thread(self.credential.get_token, self.scope)
+            return self.token.token
+
+def build_credential():
+    """Use the service principal directly when it is configured, skipping DefaultAzureCredential's probe chain"""
+    wait_for_sdks()
+    from azure.identity import ClientSecretCredential, DefaultAzureCredential, TokenCachePersistenceOptions
     
-    try:
-        # Initialize Azure OpenAI client with Entra ID authentication
-        print("Initializing Azure OpenAI client...")
-        token_provider = get_bearer_token_provider(
-            DefaultAzureCredential(),
-            "https://cognitiveservices.azure.com/.default"
+    if SERVICE_PRINCIPAL_CONFIGURED:
+        return ClientSecretCredential(
+            AZURE_TENANT_ID,
+            AZURE_CLIENT_ID,
+            AZURE_CLIENT_SECRET,
+            # Containers rarely have a keyring, hence the unencrypted fallback
+            cache_persistence_options=TokenCachePersistenceOptions(
+                name=TOKEN_CACHE_NAME,
+                allow_unencrypted_storage=True
+            )
         )
+    # Render has no managed identity endpoint, so probing for one only costs a timeout
+    return DefaultAzureCredential(
+        exclude_managed_identity_credential=True,
+        exclude_visual_studio_code_credential=True
+    )
 
-        client = AzureOpenAI(
-            azure_endpoint=endpoint,
+# Shared so every client and call uses the same cached token
+token_provider = CachedTokenProvider(TOKEN_SCOPE)
+
+# Shared by every check in this process so its connection pool and the token
+# cache are reused instead of being rebuilt per call
+client = None
+
+def get_client():
+    """Create the shared Azure OpenAI client on first use"""
+    global client
+    if client is None:
+        wait_for_sdks()
+        import httpx
+        from openai import AsyncAzureOpenAI
+        client = AsyncAzureOpenAI(
+            azure_endpoint=ENDPOINT,
             azure_ad_token_provider=token_provider,
             api_version="2025-01-01-preview",
+            max_retries=0,
+            # HTTP/2 lets concurrent probes share one TLS connection
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+                timeout=httpx.Timeout(15.0, connect=5.0)
+            ),
         )
+    return client
+
+# A plain TCP connect to the endpoint runs first, so DNS or firewall problems
+# show up within this many seconds rather than after a full HTTPS/OAuth attempt
+ENDPOINT_PROBE_TIMEOUT = 3.0
+
+# Endpoint addresses already resolved in this process, so repeat checks skip DNS
+resolved_addresses = {}
+
+async def connect_to_endpoint(host, port):
+    address = resolved_addresses.get((host, port))
+    if address is None:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        address = infos[0][4][:2]
+        resolved_addresses[(host, port)] = address
+    _, writer = await asyncio.open_connection(*address)
+    writer.close()
+    await writer.wait_closed()
+
+async def endpoint_reachable():
+    """Check the endpoint accepts TCP connections, within ENDPOINT_PROBE_TIMEOUT"""
+    url = urlparse(ENDPOINT)
+    port = url.port or (80 if url.scheme == "http" else 443)
+    try:
+        await asyncio.wait_for(connect_to_endpoint(url.hostname, port), ENDPOINT_PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        say(f"❌ Cannot reach {url.hostname}:{port}: {str(e) or 'timed out'}")
+        return False
+    return True
+
+# Conversations sent to the deployment, built once; each must get a non-empty reply
+PROBE_MESSAGES = [
+    [{"role": "user", "content": "Reply OK"}]
+]
+
+# Probes run concurrently, bounded to stay under the deployment's RPM quota
+PROBE_CONCURRENCY = 10
+
+# A smoke test should fail fast: the SDK's own retries are off and a probe that
+# hits a rate limit, connection error, timeout or 5xx is retried once here,
+# logging each attempt
+PROBE_ATTEMPTS = 2
+PROBE_RETRY_DELAY = 1.0
+
+async def first_token(client, messages):
+    """Send one conversation and return the first text the model streams back, or None"""
+    stream = await client.chat.completions.create(
+        model=DEPLOYMENT,
+        messages=messages,
+        # A one-word reply is all the check needs; cap generation right there
+        max_tokens=4,
+        stop=["!"],
+        temperature=0,
+        stream=True
+    )
+    # Any content proves the deployment works; stop at the first token
+    # rather than waiting for the whole completion
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                return chunk.choices[0].delta.content
+    finally:
+        await stream.response.aclose()
+    return None
+
+async def run_probe(client, semaphore, messages):
+    """Run one probe, retrying transient failures up to PROBE_ATTEMPTS times"""
+    # APIConnectionError also covers APITimeoutError
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    
+    async with semaphore:
+        for attempt in range(1, PROBE_ATTEMPTS + 1):
+            started = time.perf_counter()
+            try:
+                reply = await first_token(client, messages)
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                say(f"⚠️ Attempt {attempt} failed after {time.perf_counter() - started:.2f}s: {e}")
+                if attempt == PROBE_ATTEMPTS:
+                    raise
+                await asyncio.sleep(PROBE_RETRY_DELAY)
+                continue
+            say(f"Attempt {attempt} answered in {time.perf_counter() - started:.2f}s")
+            return reply
+
+async def check_azure_openai_with_env():
+    """Test the Azure OpenAI connection using environment variables"""
+    
+    say(f"Testing connection to: {ENDPOINT}")
+    say(f"Using deployment: {DEPLOYMENT}")
+    say(f"Service Principal configured: {SERVICE_PRINCIPAL_CONFIGURED}")
+    
+    if not await endpoint_reachable():
+        say("\nTroubleshooting tips:")
+        say("1. Check that the endpoint URL and deployment name are correct")
+        return False
+    
+    try:
+        # Initialize Azure OpenAI client with Entra ID authentication
+        say("Initializing Azure OpenAI client...")
+        client = get_client()
+        say("✅ Azure OpenAI client initialized successfully!")
         
-        print("✅ Azure OpenAI client initialized successfully!")
-        
-        # Test with a simple text prompt
-        print("Testing with a simple text prompt...")
-        response = client.chat.completions.create(
-            model=deployment,
-            messages=[
-                {"role": "user", "content": "Hello! Please respond with 'Connection successful!' if you can see this message."}
-            ],
-            max_tokens=50,
-            temperature=0.1
-        )
+        say(f"Testing with {len(PROBE_MESSAGES)} prompt(s)...")
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+        replies = await asyncio.gather(*(
+            run_probe(client, semaphore, messages) for messages in PROBE_MESSAGES
+        ))
         
-        if response.choices and len(response.choices) > 0:
-            print(f"✅ Response received: {response.choices[0].message.content}")
-            print("🎉 Azure OpenAI integration is working correctly!")
+        if all(replies):
+            for reply in replies:
+                say(f"✅ Response received: {reply}")
+            say("🎉 Azure OpenAI integration is working correctly!")
             return True
         else:
-            print("❌ No response received from Azure OpenAI")
+            say("❌ No response received from Azure OpenAI")
             return False
             
     except Exception as e:
-        print(f"❌ Error testing Azure OpenAI connection: {e}")
-        print("\nTroubleshooting tips:")
-        print("1. Set environment variables for service principal:")
-        print("   - AZURE_CLIENT_ID")
-        print("   - AZURE_CLIENT_SECRET") 
-        print("   - AZURE_TENANT_ID")
-        print("2. Or run 'az login' for interactive authentication")
-        print("3. Verify your Azure subscription has access to the OpenAI resource")
-        print("4. Check that the endpoint URL and deployment name are correct")
+        say(f"❌ Error testing Azure OpenAI connection: {e}")
+        say("\nTroubleshooting tips:")
+        say("1. Set environment variables for service principal:")
+        say("   - AZURE_CLIENT_ID")
+        say("   - AZURE_CLIENT_SECRET") 
+        say("   - AZURE_TENANT_ID")
+        say("2. Or run 'az login' for interactive authentication")
+        say("3. Verify your Azure subscription has access to the OpenAI resource")
+        say("4. Check that the endpoint URL and deployment name are correct")
         return False
 
+async def main():
+    """Run the check, then close the shared client before the event loop shuts down"""
+    try:
+        return await check_azure_openai_with_env()
+    finally:
+        if client is not None:
+            await client.close()
+
 if __name__ == "__main__":
-    print("🧪 Testing Azure OpenAI Integration with Environment Variables")
-    print("=" * 65)
-    
-    success = test_azure_openai_with_env()
-    
-    if success:
-        print("\n✅ All tests passed! Your Azure OpenAI integration is ready for Render deployment.")
-    else:
-        print("\n❌ Tests failed. Please check your configuration.")
-        print("\nFor Render deployment, you need to:")
-        print("1. Create a service principal: az ad sp create-for-rbac --name 'coin-analyzer-render'")
-        print("2. Set environment variables in Render dashboard:")
-        print("   - AZURE_CLIENT_ID")
-        print("   - AZURE_CLIENT_SECRET")
-        print("   - AZURE_TENANT_ID")
-        print("   - ENDPOINT_URL")
-        print("   - DEPLOYMENT_NAME") 
\ No newline at end of file
+    sdk_import.start()
+    load_settings()
+    try:
+        say("🧪 Testing Azure OpenAI Integration with Environment Variables")
+        say("=" * 65)
+        
+        success = asyncio.run(main())
+        
+        if success:
+            say("\n✅ All tests passed! Your Azure OpenAI integration is ready for Render deployment.")
+        else:
+            say("\n❌ Tests failed. Please check your configuration.")
+            say("\nFor Render deployment, you need to:")
+            say("1. Create a service principal: az ad sp create-for-rbac --name 'coin-analyzer-render'")
+            say("2. Set environment variables in Render dashboard:")
+            say("   - AZURE_CLIENT_ID")
+            say("   - AZURE_CLIENT_SECRET")
+            say("   - AZURE_TENANT_ID")
+            say("   - ENDPOINT_URL")
+            say("   - DEPLOYMENT_NAME")
+    finally:
+        flush_output()